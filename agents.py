@@ -7,151 +7,361 @@ Cette version inclut EchoAgent, DecisionAgent et RouterAgent pour les tests.
 
 from __future__ import annotations
 
+import sys
+import threading
+from collections import deque
+from queue import SimpleQueue
+from types import MappingProxyType
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Optional
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
+
+_NUMERIC = (int, float)
+
+# Réserve de petits dicts pour les payloads de réponse des agents ; au-delà de
+# _PAYLOAD_POOL_MAX_KEYS clés, l'allocateur système fait mieux qu'un recyclage.
+_PAYLOAD_POOL: Deque[Dict[str, Any]] = deque(maxlen=256)
+_PAYLOAD_POOL_MAX_KEYS = 8
+
+
+def _pooled_payload() -> Dict[str, Any]:
+    """Retourne un dict vide recyclé, ou un nouveau si la réserve est vide."""
+    try:
+        return _PAYLOAD_POOL.pop()
+    except IndexError:
+        return {}
+
+
+def _sole_refcount() -> int:
+    probe = object()
+    return sys.getrefcount(probe)
+
+
+# Compte de références d'un objet tenu par une seule variable locale (dépend de
+# l'interpréteur) : au-delà, quelqu'un d'autre le détient encore.
+_SOLE_REFCOUNT = _sole_refcount()
+
 
 # --------------------------
 # Primitives de Messagerie
 # --------------------------
-@dataclass
+@dataclass(slots=True)
 class Message:
-    sender: str
-    recipient: Optional[str] = None  # Explicite "None" pour diffusion générale
-    topic: str
-    payload: Dict[str, Any] = field(default_factory=dict)
-    meta: Dict[str, Any] = field(default_factory=dict)
-
     """Message encapsulant une communication entre agents.
     Contient :
         - `sender` : Nom de l'agent émetteur (str).
         - `recipient` : Cible spécifique (None pour diffusion générale).
         - `topic` : Sujet de la conversation (ex: "echo", "score").
         - `payload` : Données structurées à transmettre.
-        - `meta` : Métadonnées optionnelles (ex: timestamp, priorité).
+        - `meta` : Métadonnées optionnelles (ex: timestamp, priorité), None si absentes.
+        - `routed` : Vrai si le message a déjà été relayé par un RouterAgent.
+        - `pooled_payload` : Vrai si `payload` provient de la réserve de dicts ; il
+          est alors vidé et recyclé avec le message, les consommateurs ne doivent
+          donc pas le conserver au-delà de la vie du message.
+
+    Déclaré avec `slots=True` : pas de `__dict__` par instance, ce qui réduit
+    l'empreinte mémoire de l'historique et accélère l'accès aux attributs.
     """
 
+    sender: str
+    recipient: Optional[str]  # Explicite "None" pour diffusion générale
+    topic: str
+    payload: Dict[str, Any] = field(default_factory=dict)
+    meta: Optional[Dict[str, Any]] = None  # Alloué seulement si nécessaire
+    routed: bool = False
+    pooled_payload: bool = False
+    # Vrai seulement pour un message produit par `acquire` et pas encore rendu
+    _owned: bool = field(default=False, init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        # Sujet interné : les comparaisons `==` des agents se résolvent par identité
+        self.topic = sys.intern(self.topic)
+
+    # Réserve d'instances recyclées (seule la coquille est réutilisée, pas le payload)
+    _pool: ClassVar[Deque[Message]] = deque(maxlen=1024)
+
+    @classmethod
+    def acquire(
+        cls,
+        sender: str,
+        recipient: Optional[str],
+        topic: str,
+        payload: Dict[str, Any],
+    ) -> Message:
+        """Retourne un message recyclé depuis la réserve, ou en construit un nouveau.
+
+        Comme à la construction, le sujet est interné.
+        """
+        try:
+            msg = cls._pool.pop()
+        except IndexError:
+            msg = cls(sender, recipient, topic, payload)
+            msg._owned = True
+            return msg
+        msg._owned = True
+        msg.sender = sender
+        msg.recipient = recipient
+        msg.topic = sys.intern(topic)
+        msg.payload = payload
+        msg.meta = None
+        msg.routed = False
+        msg.pooled_payload = False
+        return msg
+
+    @classmethod
+    def release(cls, msg: Message) -> None:
+        """Rend un message à la réserve.
+
+        Seuls les messages produits par `acquire` sont recyclés : un message
+        construit par l'appelant est ignoré, tout comme une seconde libération.
+        L'appelant garantit que plus personne ne référence `msg` : il sera
+        réutilisé tel quel par un prochain `acquire`. Un payload issu de la
+        réserve de dicts y retourne, vidé ; les références au payload et aux
+        métadonnées sont lâchées pour ne pas les retenir dans la réserve.
+        """
+        if not msg._owned:
+            return
+        msg._owned = False
+        payload = msg.payload
+        if msg.pooled_payload and payload is not None:
+            if len(payload) <= _PAYLOAD_POOL_MAX_KEYS:
+                payload.clear()
+                _PAYLOAD_POOL.append(payload)
+        msg.payload = None
+        msg.meta = None
+        msg.pooled_payload = False
+        cls._pool.append(msg)
+
 class MessageBus:
     """Un bus de messages minimal en mémoire, centralisant les échanges entre agents."""
 
-    def __init__(self) -> None:
+    def __init__(self, history_cap: int = 10_000, force_record: bool = False) -> None:
+        if history_cap < 1:
+            raise ValueError("history_cap doit être strictement positif")
         self._agents: Dict[str, BaseAgent] = {}
-        self._history: List[Message] = []
-
-
-
-    def register(self, callback: Callable[..., Any], event_type: str) -> None:
-        """Enregistre une fonction de rappel pour un type d'événement spécifique.
+        # Méthodes `receive` liées, reconstruites à chaque inscription :
+        # par nom pour l'envoi ciblé, en tuple pour la diffusion
+        self._receiver_of: Dict[str, Callable[[Message], None]] = {}
+        self._receivers: Tuple[Callable[[Message], None], ...] = ()
+        self.history_cap = history_cap
+        # Si vrai, même les envois `record=False` sont conservés dans l'historique
+        self.force_record = force_record
+        self._history: Deque[Message] = deque(maxlen=history_cap)
+        # File des messages en attente de distribution, vidée par l'envoi le plus externe.
+        # Le verrou, pris sans attente, désigne le thread qui vide la file.
+        self._pending: Deque[Tuple[Message, bool]] = deque()
+        self._drain_lock = threading.Lock()
+
+    def register(self, agent: BaseAgent) -> None:
+        """Inscrit un agent sur le bus.
 
         Args:
-            callback (Callable[..., Any]): La fonction à appeler lors de la réception de l'événement.
-                Doit correspondre à la structure attendue du payload de l'événement.
-            event_type (str): Le nom/type de l'événement auquel s'abonner.
-
-        Returns:
-            None
+            agent (BaseAgent): L'agent à inscrire ; son nom doit être unique sur le bus.
 
         Raises:
-            ValueError: Si le callback est invalide ou déjà enregistré.
+            ValueError: Si un agent portant le même nom est déjà enregistré.
         """
         if agent.name in self._agents:
             raise ValueError(f"Nom de l'agent déjà enregistré : {agent.name}")
+        # Nom interné : `msg.sender == self.name` se résout par identité
+        agent.name = sys.intern(agent.name)
         self._agents[agent.name] = agent
         agent._bus = self
+        agent._send = self.send  # Méthode liée une fois pour toutes
+        # Un agent threadé reçoit dans sa file, vidée par son propre `run_loop` ; la
+        # référence tenue par la file empêche le recyclage avant traitement
+        self._receiver_of[agent.name] = (
+            agent._queue.put if agent.threaded else agent.receive
+        )
+        self._receivers = tuple(self._receiver_of.values())
 
-    def send(self, event_type: str, payload: Any) -> None:
-        """Envoie un événement avec son payload aux abonnés correspondants.
+    def send(self, msg: Message, *, record: bool = True) -> None:
+        """Enregistre le message dans l'historique puis le distribue.
 
-        Args:
-            event_type (str): Le nom/type de l'événement à envoyer.
-            payload (Any): Les données associées à l'événement (structure variable).
+        Les envois effectués par les agents pendant une distribution sont mis
+        en file et traités itérativement par l'appel le plus externe (ordre
+        FIFO), au lieu d'empiler des appels récursifs. Un envoi depuis un autre
+        thread pendant une distribution est confié au thread qui vide la file.
 
-        Returns:
-            None
+        Exceptions : un `send` appelé pendant une distribution (depuis un
+        handler ou un autre thread) retourne sans erreur, même si la livraison
+        de son message échoue. Une exception levée par un agent abandonne
+        seulement le message en cours (et, pour une diffusion, les agents pas
+        encore servis) ; le reste de la file est distribué, puis la première
+        exception est relevée par l'appel qui vidait la file. Une
+        `BaseException` hors `Exception` (ex: KeyboardInterrupt) vide la file
+        et se propage immédiatement.
 
-        Raises:
-            KeyError: Si le type d'événement n'est pas enregistré.
-            TypeError: Si le payload ne correspond pas aux attentes du callback.
+        Au-delà de `history_cap` messages, le plus ancien est retiré de
+        l'historique ; s'il vient d'`acquire` et que plus rien ne le référence,
+        il est rendu à la réserve de `Message`.
+
+        Args:
+            msg (Message): Le message à distribuer. Si `msg.recipient` est None,
+                il est diffusé à tous les agents inscrits.
+            record (bool): Si faux, le message est éphémère : distribué mais absent
+                de l'historique (sauf si le bus a `force_record`). S'il vient
+                d'`acquire` et que personne ne l'a conservé, ses références
+                `payload` et `meta` sont lâchées dès la distribution terminée.
+        """
+        pending = self._pending
+        pending.append((msg, record or self.force_record))
+        drain_lock = self._drain_lock
+        error: Optional[Exception] = None
+        # Nouvelle vérification après libération : un autre thread a pu enfiler
+        # un message entre la fin de la boucle et la libération du verrou.
+        while pending and drain_lock.acquire(blocking=False):
+            try:
+                history = self._history
+                history_cap = self.history_cap
+                receiver_of = self._receiver_of
+                while pending:
+                    msg, record = pending.popleft()
+                    if record:
+                        if len(history) == history_cap:
+                            evicted = history.popleft()
+                            # Encore détenu ailleurs (instantané, boîte de réception,
+                            # file d'un agent, doublon) : il n'est pas recyclé
+                            if sys.getrefcount(evicted) <= _SOLE_REFCOUNT:
+                                Message.release(evicted)
+                        history.append(msg)
+                    try:
+                        recipient = msg.recipient
+                        if recipient:
+                            receive = receiver_of.get(recipient)
+                            if receive is not None:
+                                receive(msg)
+                        else:
+                            for receive in self._receivers:
+                                receive(msg)
+                    except Exception as exc:
+                        # Seul le message fautif est abandonné ; la file continue
+                        if error is None:
+                            error = exc
+                    finally:
+                        # Message éphémère issu d'`acquire` que personne n'a gardé
+                        # (boîte de réception, file d'un agent, appelant)
+                        if (
+                            not record
+                            and msg._owned
+                            and sys.getrefcount(msg) <= _SOLE_REFCOUNT
+                        ):
+                            msg.payload = None
+                            msg.meta = None
+            except BaseException:
+                # Interruption (KeyboardInterrupt, SystemExit...) : la file est abandonnée
+                pending.clear()
+                raise
+            finally:
+                drain_lock.release()
+        if error is not None:
+            raise error
+
+    def history(self) -> Tuple[Message, ...]:
+        """Instantané de l'historique ; ses messages ne sont pas recyclés tant qu'il vit."""
+        return tuple(self._history)
+
+    def iter_history(
+        self, topic: Optional[str] = None, recipient: Optional[str] = None
+    ) -> Iterator[Message]:
+        """Itère sur l'historique sans le copier, filtré par sujet et/ou destinataire.
+
+        Args:
+            topic (Optional[str]): Ne garder que les messages de ce sujet.
+            recipient (Optional[str]): Ne garder que les messages adressés à cet agent.
         """
-        self._history.append(msg)
-        if msg.recipient:
-            agent = self._agents.get(msg.recipient)
-            if agent:
-                agent.receive(msg)
-        else:
-            for agent in self._agents.values():
-                agent.receive(msg)
-
-    def history(self) -> List[Message]:
-        return list(self._history)
+        for msg in self._history:
+            if (topic is None or msg.topic == topic) and (
+                recipient is None or msg.recipient == recipient
+            ):
+                yield msg
+
 
 # --------------------------
 # Agent de Base
 # --------------------------
 class BaseAgent:
-    def __init__(self, name: str) -> None:
-        if not name or not name.strip():
-            raise ValueError("Le nom de l'agent doit être une chaîne non vide")def register(self, callback: Callable[..., Any], event_type: str) -> None:
-    """Enregistre une fonction de rappel pour un type d'événement spécifique.
-
-    Args:
-        callback (Callable[..., Any]): La fonction à appeler lors de la réception de l'événement.
-            Doit correspondre à la structure attendue du payload de l'événement.
-        event_type (str): Le nom/type de l'événement auquel s'abonner.
-
-    Returns:
-        None
-
-    Raises:
-        ValueError: Si le callback est invalide ou déjà enregistré.
-    """
-
-    def send(self, event_type: str, payload: Any) -> None:
-        """Envoie un événement avec son payload aux abonnés correspondants.
-
-        Args:
-            event_type (str): Le nom/type de l'événement à envoyer.
-            payload (Any): Les données associées à l'événement (structure variable).
-
-        Returns:
-            None
+    # Si vrai, le bus dépose les messages dans `_queue` et l'agent les traite
+    # dans son propre thread via `run_loop()` au lieu d'être appelé en ligne.
+    threaded: ClassVar[bool] = False
+    # Si vrai, les messages reçus sont conservés dans la boîte de réception
+    track_inbox: ClassVar[bool] = False
 
-        Raises:
-            KeyError: Si le type d'événement n'est pas enregistré.
-            TypeError: Si le payload ne correspond pas aux attentes du callback.
-        """
+    def __init__(self, name: str, inbox_cap: int = 512) -> None:
+        if not name or not name.strip():
+            raise ValueError("Le nom de l'agent doit être une chaîne non vide")
         self.name = name
         self._bus: Optional[MessageBus] = None
-        self._inbox: List[Message] = []
+        self._send: Optional[Callable[..., None]] = None
+        # Tampon circulaire : seuls les `inbox_cap` derniers messages sont conservés
+        self._inbox: Deque[Message] = deque(maxlen=inbox_cap)
+        # File non bornée ; une future variante bornée devra avoir une capacité
+        # en puissance de deux. None est la sentinelle d'arrêt de `run_loop`.
+        self._queue: SimpleQueue[Optional[Message]] = SimpleQueue()
 
     def on_start(self) -> None:
         """Hook appelé après la registration (inscription)."""
         pass
 
     def send(
-        self, recipient: Optional[str], topic: str, payload: Dict[str, Any]
+        self,
+        recipient: Optional[str],
+        topic: str,
+        payload: Dict[str, Any],
+        *,
+        pooled: bool = False,
     ) -> None:
-        if not self._bus:
+        """Envoie un message via le bus ; `pooled` signale un payload obtenu via
+        `_pooled_payload()`, recyclé avec le message."""
+        send = self._send
+        if send is None:
             raise RuntimeError("L'agent n'est pas enregistré sur un MessageBus")
-        msg = Message(
-            sender=self.name,
-            recipient=recipient,
-            topic=topic,
-            payload=payload
-        )
-        self._bus.send(msg)
+        msg = Message.acquire(self.name, recipient, topic, payload)
+        msg.pooled_payload = pooled
+        send(msg)
 
     def receive(self, msg: Message) -> None:
-        """Comportement par défaut : enfile et appelle handle()."""
-        self._inbox.append(msg)
+        """Comportement par défaut : enfile si `track_inbox`, puis appelle handle()."""
+        if self.track_inbox:
+            self._inbox.append(msg)
         self.handle(msg)
 
     def handle(self, msg: Message) -> None:
         """Remplacer par une logique spécifique à l'agent."""
         pass
 
+    def run_loop(self) -> None:
+        """Traite la file de l'agent jusqu'à `stop()` ; à lancer dans un thread dédié."""
+        get = self._queue.get
+        receive = self.receive
+        while True:
+            msg = get()
+            if msg is None:
+                return
+            receive(msg)
+
+    def stop(self) -> None:
+        """Demande l'arrêt de `run_loop()` une fois les messages déjà reçus traités."""
+        self._queue.put(None)
+
     @property
-    def inbox(self) -> List[Message]:
-        return list(self._inbox)
+    def inbox(self) -> Tuple[Message, ...]:
+        """Derniers messages reçus ; toujours vide si `track_inbox` est faux."""
+        return tuple(self._inbox)
+
+    def inbox_iter(self) -> Iterator[Message]:
+        """Itère sur la boîte de réception sans la copier (ne pas recevoir pendant l'itération)."""
+        return iter(self._inbox)
 
 # --------------------------
 # EchoAgent
@@ -174,12 +384,12 @@ class EchoAgent(BaseAgent):
             Les messages non de type écho sont ignorés (actuellement loggés à la console)
             Ce traitement est une implémentation basique de fonctionnalité d'écho pour le système de messagerie.
         """
-        if msg.topic == "echo" or msg.topic.startswith("echo."):
-            self.send(
-                recipient=self.get_coordination().player_id,  # Utilise l'ID du joueur via coordination
-                topic="echo.reply",
-                payload={"echo": msg.payload}
-            )
+        topic = msg.topic
+        if topic == "echo" or topic.startswith("echo."):
+            reply = _pooled_payload()
+            # Un payload recyclable ne doit pas survivre dans la réponse : copie
+            reply["echo"] = dict(msg.payload) if msg.pooled_payload else msg.payload
+            self.send(msg.sender, "echo.reply", reply, pooled=True)
 # --------------------------
 # DecisionAgent
 # --------------------------
@@ -187,38 +397,84 @@ class DecisionAgent(BaseAgent):
     """Fait des décisions simples basées sur une note numérique."""
     def handle(self, msg: Message) -> None:
         if msg.topic == "score":
-            value = msg.payload.get("value")
-            threshold = msg.payload.get("threshold", 0)
-            if not isinstance(value, (int, float)):
-                self.send(msg.sender, "decision", {"error": "invalid_value"})
+            payload = msg.payload
+            value = payload.get("value")
+            threshold = payload.get("threshold", 0)
+            # Comparaison d'identité sur le type pour le cas courant, isinstance pour les sous-classes
+            value_type = type(value)
+            if (
+                value_type is not int
+                and value_type is not float
+                and not isinstance(value, _NUMERIC)
+            ):
+                reply = _pooled_payload()
+                reply["error"] = "invalid_value"
+                self.send(msg.sender, "decision", reply, pooled=True)
                 return
-            accepted = value >= threshold
-            self.send(
-                msg.sender,
-                "decision",
-                {"accepted": accepted, "value": value, "threshold": threshold},
-            )
+            reply = _pooled_payload()
+            reply["accepted"] = value >= threshold
+            reply["value"] = value
+            reply["threshold"] = threshold
+            self.send(msg.sender, "decision", reply, pooled=True)
 
 # --------------------------
 # RouterAgent
 # --------------------------
 class RouterAgent(BaseAgent):
-    """Routeur qui redirige les messages vers des agents spécifiques selon leur préfixe.
-    Exemple de mapping : {"echo.request": "agent1", "score.update": "decision"}."""
+    """Routeur qui redirige les messages vers des agents spécifiques selon leur sujet.
+    Une clé terminée par "." est un préfixe ("echo." couvre "echo.request"), toute
+    autre clé exige une correspondance exacte du sujet.
+    Exemple de mapping : {"echo.": "agent1", "score": "decision"}."""
     def __init__(self, name: str, mapping: Dict[str, str]) -> None:
         super().__init__(name)
-        self.mapping = dict(mapping)
+        # Tables précalculées : recherche exacte en O(1), puis préfixes regroupés
+        # par premier segment du sujet ("echo." → "echo"), du plus long au plus court
+        self._exact: Dict[str, str] = {
+            k: v for k, v in mapping.items() if not k.endswith(".")
+        }
+        buckets: Dict[str, List[Tuple[str, str]]] = {}
+        for key, agent_name in mapping.items():
+            if key.endswith("."):
+                buckets.setdefault(key.split(".", 1)[0], []).append((key, agent_name))
+        self._buckets: Dict[str, Tuple[Tuple[str, str], ...]] = {
+            head: tuple(sorted(entries, key=lambda kv: -len(kv[0])))
+            for head, entries in buckets.items()
+        }
+
+    @property
+    def mapping(self) -> Mapping[str, str]:
+        """Vue en lecture seule du mapping, reconstruite depuis les tables précalculées."""
+        mapping = dict(self._exact)
+        for entries in self._buckets.values():
+            mapping.update(entries)
+        return MappingProxyType(mapping)
 
     def handle(self, msg: Message) -> None:
-        """Route le message vers un agent cible si son préfixe correspond à une clé du mapping.
-        Exemple : Si `topic="echo.request"` et le mapping contient "echo.request" → redirige vers l'agent spécifié."""
-        if msg.sender == self.name or msg.topic.endswith(".reply"):
+        """Route le message vers l'agent cible associé à son sujet.
+        Exemple : Si `topic="echo.request"` et le mapping contient "echo." → redirige vers l'agent spécifié."""
+        # Un message déjà relayé n'est jamais re-routé : évite les boucles entre routeurs
+        if msg.routed or msg.sender == self.name:
             return
-        target = None
-        for key, agent_name in self.mapping.items():
-                if msg.topic.startswith(key):
+        topic = msg.topic
+        target = self._exact.get(topic)
+        if target is None:
+            # Le suffixe ".reply" n'est testé qu'après l'échec de la recherche exacte
+            if topic.endswith(".reply"):
+                return
+            # Un préfixe se termine par "." : un sujet sans point ne peut pas correspondre
+            dot = topic.find(".")
+            if dot < 0:
+                return
+            for prefix, agent_name in self._buckets.get(topic[:dot], ()):
+                if topic.startswith(prefix):
                     target = agent_name
                     break
         if target:
-            self.send(recipient=target, topic=msg.topic, payload=msg.payload)
-
+            payload = msg.payload
+            # Le dict recyclable reste à l'original ; le relais en a sa propre copie
+            if msg.pooled_payload:
+                payload = dict(payload)
+            forward = Message.acquire(self.name, target, topic, payload)
+            forward.routed = True
+            # Relais éphémère : seuls l'original et la réponse sont historisés
+            self._send(forward, record=False)
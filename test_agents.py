@@ -5,9 +5,29 @@ Run with:
     pytest -q --cov=agents --cov-report=term-missing
 """
 
+import sys
+import threading
+
 import pytest
 
-from agents import DecisionAgent, EchoAgent, Message, MessageBus, RouterAgent
+import agents as agents_module
+from agents import (
+    BaseAgent,
+    DecisionAgent,
+    EchoAgent,
+    Message,
+    MessageBus,
+    RouterAgent,
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_pools():
+    Message._pool.clear()
+    agents_module._PAYLOAD_POOL.clear()
+    yield
+    Message._pool.clear()
+    agents_module._PAYLOAD_POOL.clear()
 
 
 @pytest.fixture()
@@ -62,9 +82,7 @@ def test_decision_agent_threshold_logic(bus_and_agents, value, threshold, accept
             payload={"value": value, "threshold": threshold},
         )
     )
-    decision_msgs = [
-        m for m in bus.history() if m.topic == "decision" and m.recipient == "tester"
-    ]
+    decision_msgs = list(bus.iter_history(topic="decision", recipient="tester"))
     assert decision_msgs, "Expected a decision reply"
     assert decision_msgs[-1].payload["accepted"] is accepted
 
@@ -79,9 +97,7 @@ def test_decision_agent_handles_invalid_value(bus_and_agents):
             payload={"value": "NaN"},
         )
     )
-    replies = [
-        m for m in bus.history() if m.topic == "decision" and m.recipient == "tester"
-    ]
+    replies = list(bus.iter_history(topic="decision", recipient="tester"))
     assert replies[-1].payload.get("error") == "invalid_value"
 
 
@@ -115,3 +131,285 @@ def test_message_bus_register_duplicate_name():
     bus.register(a1)
     with pytest.raises(ValueError):
         bus.register(a2)
+
+
+def test_message_uses_slots_and_lazy_meta():
+    msg = Message(sender="a", recipient=None, topic="t")
+    assert not hasattr(msg, "__dict__")
+    assert msg.meta is None
+    assert msg.payload == {}
+
+
+def test_history_cap_recycles_only_unreferenced_acquired_messages():
+    bus = MessageBus(history_cap=1)
+    bus.register(EchoAgent("solo"))
+    caller_built = Message(sender="tester", recipient="solo", topic="noop")
+    bus.send(caller_built)
+    bus.send(Message.acquire("tester", "solo", "noop", {}))
+    assert not Message._pool
+    assert caller_built.topic == "noop"
+    snapshot = bus.history()
+    bus.send(Message.acquire("tester", "solo", "noop", {"k": 1}))
+    assert not Message._pool
+    assert snapshot[0].payload == {}
+    del snapshot
+    bus.send(Message(sender="tester", recipient="solo", topic="noop"))
+    assert len(Message._pool) == 1
+    reused = Message._pool[0]
+    assert Message.acquire("solo", None, "other", {}) is reused
+    assert Message.acquire("solo", None, "other", {}) is not reused
+
+
+def test_message_sent_twice_is_recycled_once():
+    bus = MessageBus(history_cap=2)
+    bus.register(EchoAgent("solo"))
+    twice = Message.acquire("tester", "solo", "noop", {})
+    bus.send(twice)
+    bus.send(twice)
+    del twice
+    for _ in range(2):
+        bus.send(Message(sender="tester", recipient="solo", topic="noop"))
+    assert len(Message._pool) == 1
+    assert Message.acquire("a", None, "t", {}) is not Message.acquire("a", None, "t", {})
+
+
+def test_router_prefers_exact_then_longest_prefix():
+    bus = MessageBus(force_record=True)
+    router = RouterAgent("r", mapping={"a.": "short", "a.b.": "long", "a.x": "exact"})
+    for a in (router, EchoAgent("short"), EchoAgent("long"), EchoAgent("exact")):
+        bus.register(a)
+    for topic in ("a.x", "a.b.c", "a.c", "a"):
+        bus.send(Message(sender="client", recipient="r", topic=topic))
+    forwards = [(m.recipient, m.topic) for m in bus.history() if m.sender == "r"]
+    assert forwards == [("exact", "a.x"), ("long", "a.b.c"), ("short", "a.c")]
+
+
+def test_unregistered_agent_cannot_send():
+    with pytest.raises(RuntimeError):
+        EchoAgent("lonely").send(None, "echo", {})
+
+
+def test_inbox_keeps_only_latest_messages():
+    class AuditEchoAgent(EchoAgent):
+        track_inbox = True
+
+    bus = MessageBus()
+    agent = AuditEchoAgent("capped", inbox_cap=2)
+    bus.register(agent)
+    for i in range(3):
+        bus.send(Message(sender="tester", recipient="capped", topic=f"t{i}"))
+    assert [m.topic for m in agent.inbox] == ["t1", "t2"]
+    assert [m.topic for m in agent.inbox_iter()] == ["t1", "t2"]
+
+
+def test_message_topic_is_interned():
+    topic = "".join(["dyn", "amic.topic"])
+    built = Message(sender="a", recipient=None, topic=topic)
+    assert built.topic is sys.intern("dynamic.topic")
+    Message.release(Message.acquire("a", None, "x", {}))
+    recycled = Message.acquire("a", None, "".join(["dyn", "amic.topic"]), {})
+    assert recycled.topic is sys.intern("dynamic.topic")
+
+
+def test_router_does_not_reroute_forwarded_messages():
+    bus = MessageBus(force_record=True)
+    first = RouterAgent("first", mapping={"job": "second"})
+    second = RouterAgent("second", mapping={"job": "first"})
+    for a in (first, second):
+        bus.register(a)
+    bus.send(Message(sender="client", recipient="first", topic="job"))
+    forwards = [m for m in bus.history() if m.routed]
+    assert [(m.sender, m.recipient) for m in forwards] == [("first", "second")]
+
+
+def test_evicted_reply_payload_returns_to_dict_pool():
+    bus = MessageBus(history_cap=2)
+    bus.register(DecisionAgent("decider"))
+    bus.send(
+        Message(sender="tester", recipient="decider", topic="score", payload={"value": 1})
+    )
+    reply = bus.history()[-1]
+    assert reply.pooled_payload
+    payload = reply.payload
+    del reply
+    for _ in range(2):
+        bus.send(Message(sender="tester", recipient="decider", topic="noop"))
+    assert payload == {}
+    assert agents_module._PAYLOAD_POOL[-1] is payload
+
+
+def test_bus_dispatches_long_chains_without_recursion():
+    class Relay(BaseAgent):
+        def __init__(self, name, target):
+            super().__init__(name)
+            self.target = target
+
+        def handle(self, msg):
+            if self.target:
+                self.send(self.target, msg.topic, msg.payload)
+
+    bus = MessageBus()
+    hops = 5 * sys.getrecursionlimit()
+    for i in range(hops):
+        bus.register(Relay(f"r{i}", f"r{i + 1}" if i + 1 < hops else None))
+    bus.send(Message(sender="client", recipient="r0", topic="hop"))
+    assert len(bus.history()) == hops
+
+
+def test_threaded_agent_handles_messages_in_its_own_loop():
+    class ThreadedDecider(DecisionAgent):
+        threaded = True
+
+    bus = MessageBus()
+    decider = ThreadedDecider("decider")
+    bus.register(decider)
+    bus.send(
+        Message(sender="tester", recipient="decider", topic="score", payload={"value": 1})
+    )
+    assert not list(bus.iter_history(topic="decision"))
+    worker = threading.Thread(target=decider.run_loop)
+    worker.start()
+    decider.stop()
+    worker.join(timeout=5)
+    assert not worker.is_alive()
+    decisions = list(bus.iter_history(topic="decision", recipient="tester"))
+    assert decisions[-1].payload["accepted"] is True
+
+
+def test_router_forwards_are_not_recorded_by_default(bus_and_agents):
+    bus, echoer, decider, router = bus_and_agents
+    bus.send(
+        Message(sender="client", recipient="router", topic="score", payload={"value": 1})
+    )
+    assert [m.topic for m in bus.history()] == ["score", "decision"]
+
+
+def test_message_references_are_dropped_after_use():
+    bus = MessageBus(history_cap=1)
+    bus.register(EchoAgent("sink"))
+    caller_built = Message(
+        sender="tester", recipient="sink", topic="noop", payload={"x": 1}
+    )
+    bus.send(caller_built, record=False)
+    assert caller_built.payload == {"x": 1}
+    evicted = Message.acquire("tester", "sink", "noop", {"x": 1})
+    evicted.meta = {"m": 1}
+    bus.send(evicted)
+    del evicted
+    bus.send(Message(sender="tester", recipient="sink", topic="noop"))
+    released = Message._pool[-1]
+    assert released.payload is None and released.meta is None
+
+
+def test_ephemeral_forward_kept_in_inbox_is_not_cleared():
+    class AuditEchoAgent(EchoAgent):
+        track_inbox = True
+
+    bus = MessageBus()
+    router = RouterAgent("router", mapping={"audit.": "auditor"})
+    auditor = AuditEchoAgent("auditor")
+    for a in (router, auditor):
+        bus.register(a)
+    bus.send(
+        Message(sender="client", recipient="router", topic="audit.x", payload={"b": 2})
+    )
+    kept = auditor.inbox[-1]
+    assert kept.routed and kept.payload == {"b": 2}
+
+
+def test_inbox_tracking_is_opt_in(bus_and_agents):
+    bus, echoer, *_ = bus_and_agents
+    bus.send(Message(sender="tester", recipient="echoer", topic="echo"))
+    assert echoer.inbox == ()
+
+
+def test_receive_dispatches_to_instance_handle(bus_and_agents):
+    bus, echoer, *_ = bus_and_agents
+    seen = []
+    echoer.handle = seen.append
+    bus.send(Message(sender="tester", recipient="echoer", topic="echo"))
+    assert [m.topic for m in seen] == ["echo"]
+    assert not list(bus.iter_history(topic="echo.reply"))
+
+
+def test_router_mapping_is_read_only(bus_and_agents):
+    *_, router = bus_and_agents
+    assert router.mapping == {"echo.": "echoer", "score": "decider"}
+    with pytest.raises(TypeError):
+        router.mapping["other"] = "x"
+
+
+def test_failing_handler_only_discards_its_own_message(bus_and_agents):
+    class Exploder(BaseAgent):
+        def handle(self, msg):
+            raise RuntimeError("boom")
+
+    class Fanout(BaseAgent):
+        def handle(self, msg):
+            if msg.topic != "go":
+                return
+            self.send("exploder", "boom", {})
+            self.send("echoer", "echo", {"after": True})
+
+    bus, *_ = bus_and_agents
+    bus.register(Exploder("exploder"))
+    bus.register(Fanout("fanout"))
+    with pytest.raises(RuntimeError, match="boom"):
+        bus.send(Message(sender="tester", recipient="fanout", topic="go"))
+    replies = list(bus.iter_history(topic="echo.reply", recipient="fanout"))
+    assert replies[-1].payload == {"echo": {"after": True}}
+    bus.send(Message(sender="tester", recipient="echoer", topic="echo"))
+    assert list(bus.iter_history(topic="echo.reply", recipient="tester"))
+
+
+def test_interrupt_in_handler_drops_queued_messages(bus_and_agents):
+    class Interrupter(BaseAgent):
+        def handle(self, msg):
+            if msg.topic == "go":
+                self.send("echoer", "echo", {"stale": True})
+                raise KeyboardInterrupt
+
+    bus, *_ = bus_and_agents
+    bus.register(Interrupter("interrupter"))
+    with pytest.raises(KeyboardInterrupt):
+        bus.send(Message(sender="tester", recipient="interrupter", topic="go"))
+    bus.send(Message(sender="tester", recipient="echoer", topic="noop"))
+    assert not list(bus.iter_history(topic="echo"))
+
+
+def test_queued_message_survives_history_eviction():
+    class ThreadedDecider(DecisionAgent):
+        threaded = True
+
+    bus = MessageBus(history_cap=1)
+    decider = ThreadedDecider("decider")
+    bus.register(decider)
+    bus.register(EchoAgent("sink"))
+    bus.send(Message.acquire("tester", "decider", "score", {"value": 1}))
+    for _ in range(2):
+        bus.send(Message(sender="tester", recipient="sink", topic="noop"))
+    decider.stop()
+    decider.run_loop()
+    assert bus.history()[-1].payload["accepted"] is True
+
+
+def test_forwarded_pooled_payload_survives_original_eviction():
+    bus = MessageBus(history_cap=2, force_record=True)
+    router = RouterAgent("router", mapping={"decision": "sink"})
+    decider = DecisionAgent("decider")
+    for a in (router, decider, EchoAgent("sink")):
+        bus.register(a)
+    decider.send("router", "decision", {"accepted": True}, pooled=True)
+    bus.send(Message(sender="tester", recipient="sink", topic="noop"))
+    forward = bus.history()[0]
+    assert forward.routed and forward.payload == {"accepted": True}
+    assert agents_module._PAYLOAD_POOL, "the original reply should have been recycled"
+
+
+def test_release_twice_is_harmless():
+    msg = Message.acquire("a", None, "t", {"k": 1})
+    msg.pooled_payload = True
+    Message.release(msg)
+    Message.release(msg)
+    assert len(Message._pool) == 1 and len(agents_module._PAYLOAD_POOL) == 1
+    assert not msg.pooled_payload